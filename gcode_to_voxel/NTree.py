@@ -24,14 +24,41 @@ __________________                   ___________________
 |                |                   |        |        |
 |________________|                   |________|________|
 
+The nodes are not stored as python objects, but in flat typed arrays
+(:obj:`NodeArray`). Each node is a row in those arrays: the index of its
+first child (the 2^N children of a node are stored contiguously) and its
+attributes. The position and size of a node are implicit in the path from the
+root, so they are not stored.
+
 Get calls will provide a full map of the tree (including repetitions) unless
 the step argument is used.
 
 All deletions of the object should use the del argument, instead of set to 0.
-This will merge the adjacent leafs if the information is the same.
-
-It also provides methods of storage in hdf5 (TODO) and parsing to discrete
-representations of the data contained.
+This will merge the adjacent leafs if the information is the same. The merge
+only visits the nodes modified by each operation, and it can be deferred to
+do a single merge after many operations:
+
+    with tree.deferred():
+        for box, value in zip(boxes, values):
+            tree[box] = value
+
+It also provides methods of storage in hdf5 and parsing to discrete
+representations of the data contained. The hdf5 files store the node arrays
+in breadth first order, and they are read lazily: when a tree is opened only
+the first levels are loaded, and the rest of the nodes are pulled from the
+file when an operation reaches them.
+
+The batch writes can run in parallel: the batch is partitioned between the
+subtrees of the first levels, and each subtree is processed in a different
+process and stitched back to the tree. The batch reads are not parallel, as
+copying the subtrees costs more than reading them.
+
+Spatial queries (aggregates of a region, nearest leaf and ray marching) use
+aggregates of the attributes of each subtree. They are calculated on the
+first query and kept updated by the set and del operations, so the queries
+only descend the nodes partially covered instead of reading every leaf. They
+are stored in the hdf5 files too, so the queries on a lazy tree only load
+the subtrees they descend.
 
 NOTE: This implementation is intended for 2d and 3d data, Consider it
 experimental when working with more than 3d.
@@ -39,7 +66,34 @@ experimental when working with more than 3d.
 @author: carlgval
 """
 
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import os
+
 import numpy as np
+import tables
+
+# Value of the children index for the nodes without children
+LEAF = -1
+# Children indexes below this value point to nodes not loaded from the hdf5
+# file: the index in the file of the first child is STUB - value
+STUB = -2
+# Operations supported by the aggregate queries
+AGGREGATES = ('count', 'sum', 'min', 'max', 'mean')
+# Aggregates cached for each internal node, in the order they are stored in
+# the hdf5 files
+CACHED_AGGREGATES = ('count', 'sum', 'min', 'max', 'occupied')
+# The parallel writes copy each subtree touched by the batch to a worker and
+# back. The copy costs about 0.2 us per node in the main process, which can
+# not be parallelized, and 0.3 us per node in the workers, while the serial
+# write of a box costs about 14 us. So the pool is only used when the batch
+# has at least a box per PARALLEL_NODES nodes of those subtrees, where 2
+# processes already take less time than one, and at least
+# PARALLEL_MIN_BOXES boxes to pay the start of the pool.
+PARALLEL_NODES = 16
+PARALLEL_MIN_BOXES = 1024
 
 
 class Ntree(object):
@@ -47,7 +101,7 @@ class Ntree(object):
 
     Binary trees representation for data with N dimensions.
 
-    This class stores the main node of the tree, and provides methods to
+    This class stores the nodes of the tree, and provides methods to
     access the data. It also performs the mapping with the operations of get
     and set, from a pre-defined input space to a discrete space with spacial
     resolution equal to range / 2^max_depth.
@@ -56,11 +110,12 @@ class Ntree(object):
         dims (int): Number of dimensions of the BSP.
         ranges (:obj:`np.array` of float): min and max for each dimension.
         n_attrs (int): Number of attributes per leaf (channels in images).
-        dflt_attrs (:obj:`list`): Default values of the attributes.
+        dflt_attrs (:obj:`np.array`): Default values of the attributes.
         resolution (:obj:`np.array` of float): minimum element size for each
             dimension.
         max_depth (int): Max recursive depth in nodes.
-        root (:obj:`Node`): The root node in the tree.
+        nodes (:obj:`NodeArray`): Storage of the nodes. The root of the tree
+            is the node 0.
 
     '''
     def __init__(self,
@@ -68,16 +123,26 @@ class Ntree(object):
                  resolution=None,
                  attrs=0,
                  n_dimensions=None,
-                 max_depth=8):
+                 max_depth=8,
+                 dtype=float):
         ''' Tree constructor method
 
         This method inits the tree and the base node for an arbitrary number
         of dimensions.
 
         Args:
-            ranges ()
+            ranges (:obj:`list` of :obj:`list` of float): [min, max] of the
+                represented space for each dimension.
+            resolution (float or :obj:`list` of float): Minimum element size.
+                If used with ranges, the max depth is calculated from it.
+            attrs (float or :obj:`list` of float): Default attributes of the
+                leafs.
+            n_dimensions (int): Number of dimensions. Only used if no ranges
+                are given.
+            max_depth (int): Max recursive depth in nodes.
+            dtype (:obj:`np.dtype`): Type of the attributes storage.
         '''
-        self.dims = len(ranges) if n_dimensions is not None else n_dimensions
+        self.dims = len(ranges) if ranges is not None else n_dimensions
 
         # Parse data to create the first node and the mapping space
         if ranges is not None:
@@ -88,10 +153,9 @@ class Ntree(object):
                     else [resolution] * len(ranges)
                 steps = np.diff(ranges, axis=-1).flatten() / resolution
                 max_depth = int(np.ceil(np.max(np.log2(steps))))
-            else:
-                # If there are ranges and no resolution, calculate it
-                resolution = np.diff(ranges, axis=-1).flatten() /\
-                    2. ** max_depth
+            # The resolution is the size of the leafs at the max depth
+            resolution = np.diff(ranges, axis=-1).flatten() /\
+                2. ** max_depth
         else:
             # If there arent ranges nor resolution, the resolution is 1
             if resolution is None:
@@ -105,239 +169,1439 @@ class Ntree(object):
         # Store the results
         self.ranges = np.array(ranges, dtype=float)
         self.resolution = np.array(resolution, dtype=float)
-        self.max_depth = max_depth
-        self.dflt_attrs = attrs if hasattr(attrs, '__len__') else [attrs]
-        self.n_attrs = len(attrs)
+        self.max_depth = int(max_depth)
+        self.dflt_attrs = np.array(attrs if hasattr(attrs, '__len__')
+                                   else [attrs], dtype=dtype)
+        self.n_attrs = len(self.dflt_attrs)
 
         # Test the attributes
         self._assert_construction()
+        # Offsets of each child inside its parent, in units of half the
+        # parent size. The order is the one used to store the children.
+        self._bits = np.array(list(np.ndindex(*[2] * self.dims)),
+                              dtype=np.int64).reshape(-1, self.dims)
         # Create the root node
-        self.root = Node(self.ranges, attrs, max_level=max_depth)
+        self.nodes = NodeArray(2 ** self.dims, self.dflt_attrs, dtype=dtype)
+        # Open hdf5 file of the nodes not loaded yet, and number of nodes
+        # whose children are still in the file
+        self._source = None
+        self._stubs = 0
+        # Nodes modified since the last merge, grouped by level
+        self._dirty = [[] for _ in range(self.max_depth + 1)]
+        self._deferred = 0
+        # Aggregates of the subtree of each internal node, once calculated.
+        # They are indexed by the block of the children of the node, so
+        # there is no space reserved for the leafs.
+        self._aggs = None
 
     def _assert_construction(self):
         ''' Method to check if the input parameters can create a feasible tree
 
         Raises:
-
+            ValueError: If the dimensions, ranges or depth are not valid.
         '''
-        # TODO
-        pass
+        if self.dims is None or self.dims < 1:
+            raise ValueError('The number of dimensions must be at least 1')
+        if self.ranges.shape != (self.dims, 2):
+            raise ValueError('Ranges must have shape [n_dimensions x 2]')
+        if np.any(np.diff(self.ranges, axis=-1) <= 0):
+            raise ValueError('Ranges must be defined as [min, max]')
+        if self.max_depth < 0:
+            raise ValueError('The max depth can not be negative')
+
+    @property
+    def n_nodes(self):
+        ''' Number of nodes (internal and leafs) in use in the tree '''
+        return self.nodes.n_nodes
+
+    @property
+    def shape(self):
+        ''' Shape of the discrete space at the max depth '''
+        return (2 ** self.max_depth,) * self.dims
 
     def __getitem__(self, coords):
         ''' Get Item wrapper
+
+        Args:
+            coords (float or slice or :obj:`list` of float / slice): Region
+                in the represented space. Missing dimensions are taken
+                complete. The step of the slices (in space units) is used to
+                sample the region.
+        Returns:
+            (:obj:`np.array`): Array of shape [n_1, ..., n_N, n_attrs] with
+                the attributes of the region.
         '''
-        coords = self._parse_coords(coords)
-        return self.root.__getitem__(coords)
+        lo, hi, step = self._parse_coords(coords)
+        if np.all(step == 1):
+            nodes = self._render(lo, hi, self.max_depth)
+            return self.nodes.attrs[nodes]
+        # Sample the leafs pointed by the steps
+        axes = [np.arange(a, b, s) for a, b, s in zip(lo, hi, step)]
+        cells = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+        nodes = self._read_points(cells.reshape(-1, self.dims))
+        return self.nodes.attrs[nodes].reshape(
+            cells.shape[:-1] + (self.n_attrs,))
 
-    def __setitem__(self, coords):
+    def __setitem__(self, coords, value):
         ''' Set Item wrapper
+
+        Args:
+            coords (float or slice or :obj:`list` of float / slice): Region
+                in the represented space.
+            value (float or :obj:`list` of float): Attributes to assign.
         '''
-        coords = self._parse_coords(coords)
-        return self.root.__getitem__(coords)
+        lo, hi, _ = self._parse_coords(coords)
+        value = self._parse_value(value)
+        self._write_boxes(lo[None], hi[None], value[None])
+        self._merge()
 
     def __delitem__(self, coords):
         ''' Del Item wrapper
+
+        Restores the default attributes in the region.
+        '''
+        self.__setitem__(coords, self.dflt_attrs)
+
+    @classmethod
+    def from_dense(cls, array, ranges=None, attrs=0, dtype=None):
+        ''' Build a tree from a dense array
+
+        The tree is built bottom-up: the array is reduced level by level,
+        marking the blocks of 2^N elements that are uniform, and then the
+        nodes are created top-down only where the blocks are not uniform.
+        The space outside the array (up to the next power of 2) is filled
+        with the default attributes.
+
+        Args:
+            array (:obj:`np.array`): Array of shape [n_1, ..., n_N, n_attrs],
+                as the ones returned by the get operations.
+            ranges (:obj:`list` of :obj:`list` of float): [min, max] of the
+                space covered by the array for each dimension. By default,
+                each element has size 1.
+            attrs (float or :obj:`list` of float): Default attributes of the
+                leafs.
+            dtype (:obj:`np.dtype`): Type of the attributes storage. By
+                default, the type of the array.
+        Returns:
+            (:obj:`Ntree`): Tree with a leaf per element of the array at the
+                max depth.
+        Raises:
+            ValueError: If the attributes do not match the last axis of the
+                array.
+        '''
+        array = np.asarray(array)
+        shape = np.array(array.shape[:-1])
+        attrs = attrs if hasattr(attrs, '__len__') \
+            else [attrs] * array.shape[-1]
+        if len(attrs) != array.shape[-1]:
+            raise ValueError('The last axis of the array must contain the %i '
+                             'attributes' % len(attrs))
+        max_depth = int(np.ceil(np.log2(max(shape.max(), 1))))
+        ranges = np.array([[0, s] for s in shape] if ranges is None
+                          else ranges, dtype=float)
+        resolution = np.diff(ranges, axis=-1).flatten() / shape
+        tree = cls(ranges=np.stack([ranges[:, 0], ranges[:, 0] +
+                                    resolution * 2 ** max_depth], axis=-1),
+                   attrs=attrs,
+                   max_depth=max_depth,
+                   dtype=dtype or array.dtype)
+        dflt = tree.dflt_attrs
+        n_children = tree.nodes.n_children
+
+        # Reduce the array: for each level, the value of the first child of
+        # each block, and if all the block is uniform
+        pyramid = [(array, None)]
+        for _ in range(max_depth):
+            values, uniform = pyramid[-1]
+            values = _blocks(_pad(values, dflt))
+            same = np.all(values == values[..., :1, :], axis=(-2, -1))
+            if uniform is not None:
+                same &= np.all(_blocks(_pad(uniform[..., None], True)),
+                               axis=(-2, -1))
+            pyramid.append((values[..., 0, :], same))
+        pyramid.reverse()
+
+        # Create the nodes top-down, in breadth first order
+        children, values = [], []
+        position = np.zeros((1, tree.dims), dtype=np.int64)
+        n_nodes = 1
+        for level_values, level_uniform in pyramid:
+            inside = np.all(position < level_values.shape[:-1], axis=-1)
+            idx = tuple(position[inside].T)
+            level_attrs = np.tile(dflt, (len(position), 1))
+            level_attrs[inside] = level_values[idx]
+            leaf = np.ones(len(position), dtype=bool)
+            if level_uniform is not None:
+                leaf[inside] = level_uniform[idx]
+            level_children = np.full(len(position), LEAF, dtype=np.int64)
+            level_children[~leaf] = n_nodes + n_children * \
+                np.arange(np.sum(~leaf))
+            n_nodes += n_children * np.sum(~leaf)
+            children.append(level_children)
+            values.append(level_attrs)
+            position = (2 * position[~leaf][:, None] +
+                        tree._bits).reshape(-1, tree.dims)
+            if not len(position):
+                break
+        tree.nodes.assign(np.concatenate(children), np.concatenate(values))
+        return tree
+
+    @contextlib.contextmanager
+    def deferred(self):
+        ''' Context manager to defer the merges of the nodes
+
+        Inside the context, the set and del operations do not merge the
+        nodes they modify. All of them are merged at once when the context
+        exits, or when compact is called.
+        '''
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            self._merge()
+
+    def compact(self):
+        ''' Merge the nodes modified since the last merge
+
+        The nodes are visited bottom-up, so the merges propagate to the
+        parents when all the siblings end with the same attributes.
+        '''
+        for level in range(self.max_depth, -1, -1):
+            if self._dirty[level]:
+                self._merge_nodes(np.unique(np.concatenate(
+                    self._dirty[level])))
+                self._dirty[level] = []
+
+    def to_hdf5(self, path):
+        ''' Store the tree in a hdf5 file
+
+        The nodes are stored in breadth first order, in two arrays with the
+        index of the first child and the attributes of each node, and the
+        parameters of the tree as attributes of the file root. The
+        aggregates of the subtree of each internal node are stored too, so
+        the queries on a lazy tree do not load the subtrees they skip. If
+        the tree was opened lazily, all its nodes are loaded first.
+
+        Args:
+            path (str): Path of the hdf5 file. It is overwritten.
+        '''
+        self._fetch_all()
+        if self._source is not None and \
+                os.path.abspath(self._source.filename) == \
+                os.path.abspath(path):
+            self.close()
+        children, attrs, levels = self._compact()
+        # Aggregates of the internal nodes, in breadth first order, that is
+        # the order of the blocks of their children in the file
+        cached = self._aggs is not None
+        self._build_aggregates()
+        order = np.concatenate(self._levels())
+        blocks = self.nodes.children[order]
+        blocks = _block(blocks[blocks != LEAF], self.nodes.n_children)
+        aggs = np.hstack([self._aggs[name][blocks].reshape(len(blocks), -1)
+                          for name in CACHED_AGGREGATES])
+        if not cached:
+            self.clear_aggregates()
+        filters = tables.Filters(complevel=1)
+        with tables.open_file(path, 'w') as hdf5_file:
+            hdf5_file.create_carray(hdf5_file.root, 'children',
+                                    obj=children, filters=filters)
+            hdf5_file.create_carray(hdf5_file.root, 'attrs',
+                                    obj=attrs, filters=filters)
+            if len(aggs):
+                hdf5_file.create_carray(hdf5_file.root, 'aggregates',
+                                        obj=aggs.astype(float),
+                                        filters=filters)
+            hdf5_attrs = hdf5_file.root._v_attrs
+            hdf5_attrs.ranges = self.ranges
+            hdf5_attrs.max_depth = self.max_depth
+            hdf5_attrs.dflt_attrs = self.dflt_attrs
+            hdf5_attrs.levels = levels
+
+    @classmethod
+    def from_hdf5(cls, path, preload=2):
+        ''' Open a tree stored in a hdf5 file
+
+        Only the first levels of the tree are read. The deeper nodes are
+        loaded when an operation reaches them, so a region of a big tree can
+        be queried without reading all the file. The spatial queries use
+        the aggregates stored in the file for the subtrees not loaded. The
+        file is kept open until all the nodes are loaded (or discarded by a
+        set or del operation) or the tree is closed.
+
+        Args:
+            path (str): Path of the hdf5 file.
+            preload (int): Deepest level read when opening the tree. With 0,
+                only the root is read.
+        Returns:
+            (:obj:`Ntree`): Tree with the data of the file.
+        '''
+        hdf5_file = tables.open_file(path, 'r')
+        hdf5_attrs = hdf5_file.root._v_attrs
+        tree = cls(ranges=hdf5_attrs.ranges,
+                   attrs=hdf5_attrs.dflt_attrs,
+                   max_depth=int(hdf5_attrs.max_depth),
+                   dtype=hdf5_file.root.attrs.dtype)
+        levels = hdf5_attrs.levels
+        n_nodes = levels[min(preload + 1, len(levels) - 1)]
+        children = hdf5_file.root.children[:n_nodes]
+        # The children not read are marked to be loaded on demand
+        children = np.where(children >= n_nodes, STUB - children, children)
+        tree.nodes.assign(children, hdf5_file.root.attrs[:n_nodes])
+        if np.any(children < LEAF):
+            tree._source = hdf5_file
+            tree._stubs = int(np.sum(children < LEAF))
+        else:
+            hdf5_file.close()
+        return tree
+
+    def close(self):
+        ''' Close the hdf5 file of a lazy tree
+
+        The nodes not loaded yet are lost, so the operations that reach
+        them fail after closing the tree. It is called when the tree is
+        deleted or used as a context manager:
+
+            with Ntree.from_hdf5(path) as tree:
+                values = tree.get_points(points)
+        '''
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __del__(self):
+        # The construction may have failed before opening any file
+        if getattr(self, '_source', None) is not None:
+            self.close()
+
+    def to_dense(self, coords=slice(None), level=None):
+        ''' Convert a region of the tree to a dense array
+
+        Args:
+            coords (float or slice or :obj:`list` of float / slice): Region
+                in the represented space. The steps are ignored.
+            level (int): Depth of the output elements. By default, the max
+                depth. When a lower level is used, each element takes the
+                value of the first leaf it contains.
+        Returns:
+            (:obj:`np.array`): Array of shape [n_1, ..., n_N, n_attrs] with
+                an element per node of the level touched by the region.
+        Raises:
+            ValueError: If the level is not between 0 and the max depth.
+        '''
+        level = self.max_depth if level is None else level
+        if not 0 <= level <= self.max_depth:
+            raise ValueError('Not valid level %s. Use a level between 0 and '
+                             '%i' % (level, self.max_depth))
+        level = int(level)
+        lo, hi, _ = self._parse_coords(coords)
+        nodes = self._render(lo, hi, level)
+        return self.nodes.attrs[nodes]
+
+    def set_points(self, points, values, processes=None):
+        ''' Set a batch of points
+
+        Assign attributes to the leafs that contain each point. The whole
+        batch is applied in a single traversal of the tree, so this is much
+        faster than setting the points one by one. If several points fall
+        in the same leaf, the last one prevails. Points outside the tree
+        ranges are ignored.
+
+        Args:
+            points (:obj:`np.array` of float): Array of shape
+                [n_points, n_dimensions] with the coordinates of the points.
+            values (:obj:`np.array`): Array of shape [n_points, n_attrs] with
+                the attributes of each point, or a single value for all
+                of them.
+            processes (int): Number of processes used to build the tree.
+                By default, or if the batch is small compared to the
+                subtrees it modifies (see PARALLEL_NODES), the batch is
+                applied in the current process.
+        '''
+        cells, inside = self._parse_points(points)
+        values = self._parse_values(values, len(cells))
+        self._write(cells[inside], cells[inside] + 1, values[inside],
+                    processes)
+
+    def set_boxes(self, boxes, values, processes=None):
+        ''' Set a batch of axis aligned boxes
+
+        Assign attributes to the regions covered by each box in a single
+        traversal of the tree. If several boxes overlap, the last one
+        prevails.
+
+        Args:
+            boxes (:obj:`np.array` of float): Array of shape
+                [n_boxes, n_dimensions, 2] with the [min, max] of each box,
+                in the same format as the ranges of the tree.
+            values (:obj:`np.array`): Array of shape [n_boxes, n_attrs] with
+                the attributes of each box, or a single value for all
+                of them.
+            processes (int): Number of processes used to build the tree.
+                By default, or if the batch is small compared to the
+                subtrees it modifies (see PARALLEL_NODES), the batch is
+                applied in the current process.
+        '''
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, self.dims, 2)
+        values = self._parse_values(values, len(boxes))
+        size = 2 ** self.max_depth
+        lo = np.floor((boxes[..., 0] - self.ranges[:, 0]) /
+                      self.resolution + 1e-9).astype(np.int64)
+        hi = np.ceil((boxes[..., 1] - self.ranges[:, 0]) /
+                     self.resolution - 1e-9).astype(np.int64)
+        lo = np.clip(lo, 0, size)
+        hi = np.clip(hi, lo, size)
+        self._write(lo, hi, values, processes)
+
+    def get_points(self, points):
+        ''' Get a batch of points
+
+        Read the attributes of the leafs that contain each point, descending
+        the tree for the whole batch at the same time. The reads are not
+        parallelized: copying the subtrees to other processes costs more
+        than the vectorized descent.
+
+        Args:
+            points (:obj:`np.array` of float): Array of shape
+                [n_points, n_dimensions] with the coordinates of the points.
+        Returns:
+            (:obj:`np.array`): Array of shape [n_points, n_attrs]. The points
+                outside the tree ranges get the default attributes.
+        '''
+        cells, inside = self._parse_points(points)
+        out = np.tile(self.dflt_attrs, (len(cells), 1))
+        nodes = self._read_points(cells[inside])
+        out[inside] = self.nodes.attrs[nodes]
+        return out
+
+    def aggregate(self, coords=slice(None), op='sum'):
+        ''' Aggregate the attributes of a region
+
+        The nodes completely inside the region use the aggregates of their
+        subtrees, so only the nodes in the border of the region are
+        traversed.
+
+        Args:
+            coords (float or slice or :obj:`list` of float / slice): Region
+                in the represented space. The steps are ignored.
+            op (str): Aggregate to calculate for each attribute: 'count'
+                (number of leafs at the max depth with the attribute
+                different from the default), 'sum', 'min', 'max' or 'mean'.
+                The sum and mean weight each leaf by its size.
+        Returns:
+            (:obj:`np.array`): Array of n_attrs values.
+        Raises:
+            ValueError: If the operation is not supported.
+        '''
+        if op not in AGGREGATES:
+            raise ValueError('Not valid aggregate %s. Use one of %s'
+                             % (op, ', '.join(AGGREGATES)))
+        lo, hi, _ = self._parse_coords(coords)
+        self._build_aggregates()
+        count = np.zeros(self.n_attrs)
+        total = np.zeros(self.n_attrs)
+        low = np.full(self.n_attrs, np.inf)
+        high = np.full(self.n_attrs, -np.inf)
+        node = np.zeros(int(np.all(lo < hi)), dtype=np.int64)
+        origin = np.zeros((len(node), self.dims), dtype=np.int64)
+        level = 0
+        while len(node):
+            size = 2 ** (self.max_depth - level)
+            overlap = np.prod(np.minimum(hi, origin + size) -
+                              np.maximum(lo, origin), axis=-1)
+            # The leafs and the nodes inside the region are aggregated, the
+            # rest are passed to their children
+            done = (self.nodes.children[node] == LEAF) | \
+                (overlap == size ** self.dims)
+            aggs = self._node_aggregates(node[done], level, overlap[done])
+            count += aggs['count'].sum(0)
+            total += aggs['sum'].sum(0)
+            low = np.minimum(low, aggs['min'].min(0, initial=np.inf))
+            high = np.maximum(high, aggs['max'].max(0, initial=-np.inf))
+            node, origin = node[~done], origin[~done]
+            self._fetch(node)
+            half = size // 2
+            node = (self.nodes.children[node][:, None] +
+                    np.arange(self.nodes.n_children)).ravel()
+            origin = (origin[:, None] + self._bits * half).reshape(
+                -1, self.dims)
+            inside = np.all((lo < origin + half) & (hi > origin), axis=-1)
+            node, origin = node[inside], origin[inside]
+            level += 1
+        return {'count': count,
+                'sum': total,
+                'min': low,
+                'max': high,
+                'mean': total / max(np.prod(hi - lo), 1)}[op]
+
+    def clear_aggregates(self):
+        ''' Release the aggregates of the subtrees
+
+        They are kept updated after the first query, using memory for each
+        internal node. The next query calculates them again.
+        '''
+        self._aggs = None
+
+    def nearest(self, point, occupied=True):
+        ''' Find the nearest occupied (or empty) leaf to a point
+
+        A leaf is occupied if any of its attributes is different from the
+        default. The nodes are visited in order of distance to the point,
+        and the subtrees without any leaf of the requested kind are skipped.
+
+        Args:
+            point (:obj:`list` of float): Coordinates of the point.
+            occupied (bool): Search the nearest occupied leaf if True, or
+                the nearest empty leaf otherwise.
+        Returns:
+            (:obj:`tuple`): Distance to the element at the max depth found,
+                coordinates of its center and its attributes. None if there
+                is no element of the requested kind.
         '''
-        coords = self._parse_coords(coords)
-        return self.root.__getitem__(coords)
+        self._build_aggregates()
+        point = (np.asarray(point, dtype=float) - self.ranges[:, 0]) / \
+            self.resolution
+
+        def distance(origin, size):
+            delta = np.maximum(np.maximum(origin - point,
+                                          point - (origin + size)), 0)
+            return np.sqrt(np.sum((delta * self.resolution) ** 2, axis=-1))
+
+        return self._search(distance, lambda origin, size, key: point,
+                            occupied)
+
+    def raycast(self, origin, direction, occupied=True, max_distance=np.inf):
+        ''' March a ray through the tree
+
+        Find the first occupied (or empty) leaf crossed by a ray. The nodes
+        are visited in the order the ray enters them, and the subtrees
+        without any leaf of the requested kind are skipped.
+
+        Args:
+            origin (:obj:`list` of float): Coordinates of the start of the
+                ray.
+            direction (:obj:`list` of float): Direction of the ray.
+            occupied (bool): Search the first occupied leaf if True, or the
+                first empty leaf otherwise.
+            max_distance (float): Max length of the ray.
+        Returns:
+            (:obj:`tuple`): Distance along the ray to the element at the max
+                depth found, coordinates of its center and its attributes.
+                None if the ray does not cross any element of the requested
+                kind.
+        '''
+        self._build_aggregates()
+        direction = np.asarray(direction, dtype=float)
+        direction = direction / np.linalg.norm(direction)
+        start = (np.asarray(origin, dtype=float) - self.ranges[:, 0]) / \
+            self.resolution
+        # Displacement in leafs per unit of distance along the ray
+        speed = direction / self.resolution
+
+        def entry(origin, size):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_1 = (origin - start) / speed
+                t_2 = (origin + size - start) / speed
+            # The dimensions parallel to the ray do not limit the entry and
+            # exit, but the ray misses the node if it starts out of its slab
+            parallel = speed == 0
+            inside = (start >= origin) & (start < origin + size)
+            miss = np.any(parallel & ~inside, axis=-1)
+            t_1 = np.where(parallel, -np.inf, t_1)
+            t_2 = np.where(parallel, np.inf, t_2)
+            t_in = np.maximum(np.max(np.minimum(t_1, t_2), axis=-1), 0)
+            t_out = np.min(np.maximum(t_1, t_2), axis=-1)
+            return np.where(~miss & (t_in < t_out) & (t_in <= max_distance),
+                            t_in, np.inf)
+
+        return self._search(entry,
+                            lambda origin, size, key: start + key * speed,
+                            occupied)
+
+    def _parse_value(self, value):
+        ''' Convert a value to an array of n_attrs attributes
+
+        Raises:
+            ValueError: If the value has not n_attrs elements.
+        '''
+        value = np.array(value if hasattr(value, '__len__') else
+                         [value] * self.n_attrs,
+                         dtype=self.nodes.attrs.dtype).flatten()
+        if len(value) != self.n_attrs:
+            raise ValueError('Expected %i attributes, got %i'
+                             % (self.n_attrs, len(value)))
+        return value
+
+    def _parse_values(self, values, n):
+        ''' Convert a batch of values to an array of shape [n, n_attrs]
+
+        Raises:
+            ValueError: If the values can not be broadcasted to the batch.
+        '''
+        values = np.asarray(values, dtype=self.nodes.attrs.dtype)
+        if values.ndim < 2:
+            # One value per element of a single attribute tree, or one set
+            # of attributes for all the batch
+            values = values.reshape(-1, 1) if self.n_attrs == 1 \
+                else values.reshape(1, -1)
+        if values.shape[1] != self.n_attrs or len(values) not in (1, n):
+            raise ValueError('Values of shape %s can not be assigned to %i '
+                             'elements with %i attributes'
+                             % (values.shape, n, self.n_attrs))
+        return np.broadcast_to(values, (n, self.n_attrs))
+
+    def _parse_points(self, points):
+        ''' Convert a batch of points to discrete coordinates
+
+        Args:
+            points (:obj:`np.array` of float): Array of shape
+                [n_points, n_dimensions] in the represented space.
+        Returns:
+            (:obj:`tuple` of :obj:`np.array`): The leaf coordinates of each
+                point, and a mask of the points inside the tree ranges.
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, self.dims)
+        cells = np.floor((points - self.ranges[:, 0]) / self.resolution +
+                         1e-9).astype(np.int64)
+        inside = np.all((cells >= 0) & (cells < 2 ** self.max_depth),
+                        axis=-1)
+        return cells, inside
 
     def _parse_coords(self, coords):
-        ''' Convert a set of coords to a set of slices
+        ''' Convert a set of coords to a discrete region
 
         This method takes as input a set of float / slices of floats that
-        point to a region in the represented space, and convert them to a set
-        of dicrete slices indexable in the binary space.
+        point to a region in the represented space, and convert them to a
+        region of leafs indexable in the binary space.
 
         Args:
             coords(:obj:`list` of float or float or :obj:`np.array` of float):
                 The coordinates to convert in the represented space.
         Returns:
-            (:obj:`list` of :obj:`slice`): Discretized slices.
+            (:obj:`tuple` of :obj:`np.array` of int): Discretized start,
+                (excluded) end and step of the region in each dimension,
+                clipped to the tree limits.
         '''
-        # TODO : REARRANGE
-        if not hasattr(coords, '__len__'):
-            coords = [coords]
-        assert len(coords) <= self.dims
-        ranges = self.ranges.copy()
+        coords = [coords] if type(coords) is slice or \
+            not hasattr(coords, '__len__') else list(coords)
+        if len(coords) > self.dims:
+            raise IndexError('Too many coordinates for a %id tree'
+                             % self.dims)
+        size = 2 ** self.max_depth
+        lo = np.zeros(self.dims, dtype=np.int64)
+        hi = np.full(self.dims, size, dtype=np.int64)
+        step = np.ones(self.dims, dtype=np.int64)
         for i, el in enumerate(coords):
+            origin, res = self.ranges[i][0], self.resolution[i]
             if type(el) is slice:
-                start = el.start if el.start is not None \
-                    else float(self.ranges[i][0])
-                end = el.stop if el.stop is not None \
-                    else float(self.ranges[i][1])
+                if el.start is not None:
+                    lo[i] = np.floor((el.start - origin) / res + 1e-9)
+                if el.stop is not None:
+                    hi[i] = np.ceil((el.stop - origin) / res - 1e-9)
+                if el.step is not None:
+                    step[i] = max(1, int(round(el.step / res)))
             else:
-                start = float(el)
-                end = start + float(np.diff(self.ranges[i])) /\
-                    (2 ** (self.max_level - self.level))
-            ranges[i] = [start, end]
-        ranges = np.array(ranges)
-        print(ranges)
-        return ranges
-        pass
+                lo[i] = np.floor((float(el) - origin) / res + 1e-9)
+                hi[i] = lo[i] + 1
+        lo = np.clip(lo, 0, size)
+        hi = np.clip(hi, lo, size)
+        return lo, hi, step
 
+    def _render(self, lo, hi, level):
+        ''' Map a region to the nodes of a level
 
-class Node(object):
-    ''' Node object
+        The tree is expanded one level at a time as a dense grid of node
+        indexes, cropped to the region: the leafs are repeated and the
+        internal nodes replaced by their children.
 
-    BSP Node object
+        Args:
+            lo, hi (:obj:`np.array` of int): Region in leafs at the max depth.
+            level (int): Depth of the elements of the output grid.
+        Returns:
+            (:obj:`np.array` of int): Grid with the index of the node that
+                contains each element. Deeper nodes are replaced by their
+                first leaf.
+        '''
+        cell = 2 ** (self.max_depth - level)
+        r_lo, r_hi = lo // cell, -(-hi // cell)
+        if np.any(r_lo >= r_hi):
+            return np.zeros(np.maximum(r_hi - r_lo, 0), dtype=np.int64)
+        weights = 2 ** np.arange(self.dims - 1, -1, -1)
+        grid = np.zeros([1] * self.dims, dtype=np.int64)
+        w_lo = np.zeros(self.dims, dtype=np.int64)
+        for current in range(1, level + 1):
+            factor = 2 ** (level - current)
+            n_lo, n_hi = r_lo // factor, -(-r_hi // factor)
+            self._fetch(grid.ravel())
+            for axis in range(self.dims):
+                grid = np.repeat(grid, 2, axis=axis)
+            grid = grid[tuple(slice(a, b) for a, b in
+                              zip(n_lo - 2 * w_lo, n_hi - 2 * w_lo))]
+            code = sum(((np.arange(a, b) & 1) * w).reshape(
+                [-1 if i == axis else 1 for i in range(self.dims)])
+                for axis, (a, b, w) in enumerate(zip(n_lo, n_hi, weights)))
+            first = self.nodes.children[grid]
+            grid = np.where(first == LEAF, grid, first + code)
+            w_lo = n_lo
+        # Sample the nodes deeper than the level
+        self._fetch(grid.ravel())
+        first = self.nodes.children[grid]
+        while np.any(first != LEAF):
+            grid = np.where(first == LEAF, grid, first)
+            self._fetch(grid.ravel())
+            first = self.nodes.children[grid]
+        return grid
+
+    def _write(self, lo, hi, values, processes=None):
+        ''' Apply a batch of discrete boxes, in parallel if requested '''
+        if processes is not None and processes > 1 and self.max_depth:
+            self._write_parallel(lo, hi, values, processes)
+        else:
+            self._write_boxes(lo, hi, values)
+        self._merge()
 
+    def _write_parallel(self, lo, hi, values, processes):
+        ''' Parallel batch set operation
 
-    '''
-    def __init__(self, ranges, attrs=None, level=0, max_level=None):
-        ''' Init method
+        The boxes are clipped to the subtrees of a level of the tree, and
+        each subtree is copied to a process that applies its boxes. The
+        subtrees built are grafted back in the tree. If the batch is small
+        compared to the subtrees, it is applied in the current process.
 
-        Constructor of Nodes
+        Args:
+            lo, hi (:obj:`np.array` of int): Start and (excluded) end of each
+                box, as in _write_boxes.
+            values (:obj:`np.array`): Attributes of each box.
+            processes (int): Number of processes.
         '''
-        self.dims = len(ranges.shape)
-        self.centers = ranges.mean(-1)
-        self.ranges = ranges
-        self.attrs = attrs
-        self.level = level
-        self.max_level = max_level
-        self.nodes = None
+        level = self._split_level(processes)
+        sub = 2 ** (self.max_depth - level)
+        box = np.flatnonzero(np.all(lo < hi, axis=-1))
+        # Split each box in one piece per subtree it intersects
+        first, last = lo[box] // sub, (hi[box] - 1) // sub
+        extent = last - first + 1
+        counts = np.prod(extent, axis=-1)
+        piece = np.arange(np.sum(counts)) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        box, first, extent = np.repeat(box, counts), \
+            np.repeat(first, counts, axis=0), np.repeat(extent, counts, axis=0)
+        cell = np.empty_like(first)
+        for axis in range(self.dims - 1, -1, -1):
+            cell[:, axis] = first[:, axis] + piece % extent[:, axis]
+            piece //= extent[:, axis]
+        # Group the pieces by subtree, keeping the order of the boxes
+        key = np.ravel_multi_index(tuple(cell.T), (2 ** level,) * self.dims)
+        order = np.lexsort((box, key))
+        box, cell, key = box[order], cell[order], key[order]
+        keys, starts = np.unique(key, return_index=True)
+        if len(box) < PARALLEL_MIN_BOXES or not self._smaller_than(
+                self._nodes_at(cell[starts], level)[0],
+                len(box) * PARALLEL_NODES):
+            self._write_boxes(lo, hi, values)
+            return
+        nodes, touched = self._nodes_at(cell[starts], level, split=True)
+        tasks = []
+        for node, origin, group in zip(nodes, cell[starts] * sub,
+                                       np.split(box, starts[1:])):
+            children, attrs, _ = self._compact(node)
+            tasks.append((children, attrs,
+                          np.clip(lo[group] - origin, 0, sub),
+                          np.clip(hi[group] - origin, 0, sub),
+                          values[group], self.dflt_attrs,
+                          self.max_depth - level))
+        for node, (children, attrs) in zip(
+                nodes, _map(_write_subtree, tasks, processes)):
+            self._graft(node, children, attrs)
+        self._dirty[level].append(nodes)
+        if self._aggs is not None:
+            for node in nodes:
+                levels = self._levels(node)
+                for depth in range(len(levels) - 1, -1, -1):
+                    self._update_aggregates(levels[depth], level + depth)
+            for depth in range(len(touched) - 1, -1, -1):
+                self._update_aggregates(touched[depth], depth)
+
+    def _split_level(self, processes):
+        ''' Level used to partition the parallel writes
+
+        It is the first level with at least 4 subtrees per process, so the
+        work is balanced even if the data is not evenly distributed.
+        '''
+        level = int(np.ceil(np.log2(4 * processes) / self.dims))
+        return min(max(level, 1), self.max_depth)
 
-    def __getitem__(self, coords):
-        ''' Get item operation in BSP structure.
+    def _nodes_at(self, cells, level, split=False):
+        ''' Find the nodes of a level that contain some cells
 
         Args:
-            coords(:obj:`list` of :obj:`slice`): Indexes to perform the get
-                operation.
+            cells (:obj:`np.array` of int): Coordinates of the cells in the
+                level.
+            level (int): Level of the cells.
+            split (bool): If True, the leafs above the level are split, so
+                all the nodes returned are at the level. Otherwise, the
+                leafs that contain the cells are returned.
         Returns:
-            (:obj:`np.array`): Array of size [[(s.stop - s.start) / s.step]
-                for s in coords.
+            (:obj:`tuple`): Index of the node of each cell, and the nodes
+                traversed in each level above.
         '''
-        if self.nodes is not None:
-            return self._read_nodes(coords)
-        else:
-            out_shape = [[(s.stop - s.start) / s.step] for s in coords]
-            return np.tile(self.attrs, out_shape)
-
-    def __setitem__(self, coords, value):
-        ''' Set item operation in BSP structure.
+        weights = 2 ** np.arange(self.dims - 1, -1, -1)
+        node = np.zeros(len(cells), dtype=np.int64)
+        touched = []
+        for depth in range(level):
+            self._fetch(node)
+            if split:
+                touched.append(np.unique(node))
+                self._dirty[depth].append(touched[-1])
+                self._split(touched[-1])
+            first = self.nodes.children[node]
+            code = ((cells >> (level - depth - 1)) & 1).dot(weights)
+            node = np.where(first == LEAF, node, first + code)
+        return node, touched
+
+    def _smaller_than(self, roots, limit):
+        ''' Check if some subtrees have less nodes than a limit in total
+
+        The traversal stops when the limit is reached, so its cost is
+        bounded by the limit. The subtrees with nodes not loaded from the
+        hdf5 file are considered bigger than any limit, because all their
+        nodes would be loaded.
 
         Args:
-            coords(:obj:`list` of :obj:`slice`): Indexes to perform the get
-                operation.
-            value (:obj:): Object of size n_attrs that will be assigned to the
-                correspondant children.
+            roots (:obj:`np.array` of int): Index of the roots of the
+                subtrees.
+            limit (int): Max number of nodes.
         Returns:
-            (bool): True if the operation is a success.
+            (bool): True if the subtrees have less than limit nodes.
         '''
-        if self.level <= self.max_level and not self._contained_by(coords):
-            if self.nodes is None:
-                self._split()
-            self._set_nodes(coords, value)
-            self._merge()
-        else:
-            self.attrs = value
-        return True
+        nodes = np.unique(roots)
+        total = len(nodes)
+        while len(nodes) and total < limit:
+            first = self.nodes.children[nodes]
+            if np.any(first < LEAF):
+                return False
+            first = first[first != LEAF]
+            nodes = (first[:, None] + np.arange(self.nodes.n_children)).ravel()
+            total += len(nodes)
+        return total < limit
+
+    def _graft(self, node, children, attrs):
+        ''' Replace the subtree of a node
 
-    def _merge(self):
-        ''' Perform a recursive merge operation
+        Args:
+            node (int): Index of the node.
+            children (:obj:`np.array` of int): Index of the first child of
+                each node of the new subtree, whose root is the node 0.
+            attrs (:obj:`np.array`): Attributes of each node of the new
+                subtree.
+        '''
+        self._prune(np.array([node]))
+        self.nodes.attrs[node] = attrs[0]
+        # Copy the subtree level by level in allocated blocks, so the ones
+        # released by the prune are reused
+        nodes, rows = np.array([node]), np.array([0])
+        while True:
+            first = children[rows]
+            nodes, first = nodes[first != LEAF], first[first != LEAF]
+            if not len(nodes):
+                return
+            starts = self.nodes.alloc(attrs[first])
+            rows = (first[:, None] + np.arange(self.nodes.n_children)).ravel()
+            self.nodes.children[nodes] = starts
+            nodes = (starts[:, None] +
+                     np.arange(self.nodes.n_children)).ravel()
+            self.nodes.attrs[nodes] = attrs[rows]
+
+    def _write_boxes(self, lo, hi, values):
+        ''' Batch set operation
+
+        Apply an ordered batch of discrete boxes in a single traversal of the
+        tree. The traversal is done level by level for the whole batch: the
+        pairs (box, node) are partitioned at once between the children of
+        the nodes, instead of walking the tree once per box. When several
+        boxes overlap, the last one prevails.
 
-        Try to perform a merge operation recursively. For each node, perform
-        the merge if possible, and then compare all nodes attributes and merge
-        them if they are equal.
+        Args:
+            lo, hi (:obj:`np.array` of int): Arrays of shape
+                [n_boxes, n_dimensions] with the start and (excluded) end
+                leafs of each box, clipped to the tree limits.
+            values (:obj:`np.array`): Array of shape [n_boxes, n_attrs] with
+                the attributes to assign.
+        '''
+        box = np.flatnonzero(np.all(lo < hi, axis=-1))
+        node = np.zeros(len(box), dtype=np.int64)
+        origin = np.zeros((len(box), self.dims), dtype=np.int64)
+        touched = []
+        level = 0
+        while len(box):
+            size = 2 ** (self.max_depth - level)
+            full = np.all((lo[box] <= origin) & (hi[box] >= origin + size),
+                          axis=-1)
+            # Last box covering completely each node: it overwrites the
+            # node and every previous box inside it
+            nodes, inv = np.unique(node, return_inverse=True)
+            self._dirty[level].append(nodes)
+            touched.append(nodes)
+            last = np.full(len(nodes), -1, dtype=np.int64)
+            np.maximum.at(last, inv[full], box[full])
+            covered = last >= 0
+            self._prune(nodes[covered])
+            self.nodes.attrs[nodes[covered]] = values[last[covered]]
+            # The boxes after it only cover part of the node, so they are
+            # passed to the children
+            keep = box > last[inv]
+            box, node, origin = box[keep], node[keep], origin[keep]
+            if not len(box):
+                break
+            self._fetch(node)
+            self._split(np.unique(node))
+            # Partition the pairs between the children that intersect them
+            half = size // 2
+            n_children = self.nodes.n_children
+            box = np.repeat(box, n_children)
+            node = (self.nodes.children[node][:, None] +
+                    np.arange(n_children)).ravel()
+            origin = (origin[:, None] + self._bits * half).reshape(
+                -1, self.dims)
+            inside = np.all((lo[box] < origin + half) & (hi[box] > origin),
+                            axis=-1)
+            box, node, origin = box[inside], node[inside], origin[inside]
+            level += 1
+        # Update the aggregates of the modified nodes, bottom-up
+        if self._aggs is not None:
+            for level in range(len(touched) - 1, -1, -1):
+                self._update_aggregates(touched[level], level)
+
+    def _read_points(self, cells):
+        ''' Batch get operation
+
+        Find the leafs that contain a batch of discrete points, descending
+        all of them at the same time, one level per iteration.
 
+        Args:
+            cells (:obj:`np.array` of int): Array of shape
+                [n_points, n_dimensions] with the leaf of each point.
         Returns:
-            (bool): True if the merge is succesfull, False otherwise.
-        '''
-        # No children: already merged
-        if self.nodes is None:
-            return True
-        # Try to merge grandchildren
-        if not all(n._merge() for n in self.nodes.flatten()):
-            return False
-        # Compare all nodes to the first one
-        cmp_val = self.nodes.flatten()[0].attrs
-        if all(cmp_val == n.attrs for n in self.nodes.flatten()):
-            # If all are equal, delete them
-            self.attrs = cmp_val
-            self.nodes = None
-            return True
-        return False
-
-
-    def _split(self):
-        ''' Split node in sub-nodes
-
-        This method create 2 ^ N subnodes for the current node and stores
-        them as objects.
+            (:obj:`np.array` of int): Index of the leaf of each point.
+        '''
+        weights = 2 ** np.arange(self.dims - 1, -1, -1)
+        node = np.zeros(len(cells), dtype=np.int64)
+        idx = np.arange(len(cells))
+        for level in range(self.max_depth):
+            self._fetch(node[idx])
+            first = self.nodes.children[node[idx]]
+            internal = first != LEAF
+            idx, first = idx[internal], first[internal]
+            if not len(idx):
+                break
+            shift = self.max_depth - level - 1
+            node[idx] = first + ((cells[idx] >> shift) & 1).dot(weights)
+        return node
+
+    def _fetch(self, nodes):
+        ''' Load the children of the nodes from the hdf5 file if needed
 
+        Args:
+            nodes (:obj:`np.array` of int): Index of the nodes that will be
+                traversed.
+        Raises:
+            ValueError: If the nodes are not loaded and the file is closed.
         '''
-        nodes_ranges = self._divide_ranges(self.ranges)
-        self.nodes = np.empty([2] * self.dims, dtype=object)
-        for idx, n in np.ndenumerate(self.nodes):
-            range_idx = np.array(idx).reshape(-1, 1)
-            self.nodes[idx] = Node(attrs=self.attrs,
-                                   level=self.level + 1,
-                                   max_level=self.max_level)
+        if not self._stubs:
+            return
+        nodes = nodes[self.nodes.children[nodes] < LEAF]
+        if not len(nodes):
+            return
+        if self._source is None:
+            raise ValueError('The hdf5 file of the tree is closed and the '
+                             'nodes were not loaded')
+        nodes = np.unique(nodes)
+        file_first = STUB - self.nodes.children[nodes]
+        order = np.argsort(file_first)
+        nodes, file_first = nodes[order], file_first[order]
+        rows = (file_first[:, None] +
+                np.arange(self.nodes.n_children)).ravel()
+        children = self._source.root.children[rows]
+        attrs = self._source.root.attrs[rows, :]
+        starts = self.nodes.alloc(np.zeros((len(nodes), self.n_attrs)))
+        new = (starts[:, None] + np.arange(self.nodes.n_children)).ravel()
+        self.nodes.children[new] = np.where(children == LEAF, LEAF,
+                                            STUB - children)
+        self.nodes.attrs[new] = attrs
+        self.nodes.children[nodes] = starts
+        if self._aggs is not None:
+            self._grow_aggregates()
+            aggs = self._read_aggregates(file_first)
+            for name in CACHED_AGGREGATES:
+                self._aggs[name][_block(starts, self.nodes.n_children)] = \
+                    aggs[name]
+        self._drop_stubs(len(nodes) - np.sum(children != LEAF))
+
+    def _read_aggregates(self, file_first):
+        ''' Read from the hdf5 file the aggregates of some nodes not loaded
 
-    def _divide_ranges(self, ranges):
-        ''' Divide ranges method
+        Args:
+            file_first (:obj:`np.array` of int): Index in the file of the
+                first child of each node.
+        Returns:
+            (:obj:`dict`): Arrays with the count, sum, min, max and number
+                of occupied leafs of each node.
+        Raises:
+            ValueError: If the file is closed.
+        '''
+        if self._source is None:
+            raise ValueError('The hdf5 file of the tree is closed and the '
+                             'nodes were not loaded')
+        blocks, inv = np.unique(_block(file_first, self.nodes.n_children),
+                                return_inverse=True)
+        rows = self._source.root.aggregates[blocks, :][inv]
+        n = self.n_attrs
+        return {'count': rows[:, :n].astype(np.int64),
+                'sum': rows[:, n:2 * n],
+                'min': rows[:, 2 * n:3 * n],
+                'max': rows[:, 3 * n:4 * n],
+                'occupied': rows[:, 4 * n].astype(np.int64)}
+
+    def _drop_stubs(self, n):
+        ''' Update the number of nodes not loaded from the hdf5 file
+
+        The file is closed when all the nodes are loaded.
 
-        This methods splits the slices objects using the central hyperplanes,
-        to pass the splitted slices to the node's children.
+        Args:
+            n (int): Number of nodes loaded or discarded, minus the number
+                of new nodes not loaded.
+        '''
+        self._stubs -= int(n)
+        if not self._stubs:
+            self.close()
+
+    def _fetch_all(self):
+        ''' Load all the nodes from the hdf5 file and close it '''
+        if not self._stubs:
+            return
+        nodes = np.flatnonzero(self.nodes.children[:self.nodes.size] < LEAF)
+        while len(nodes):
+            self._fetch(nodes)
+            nodes = (self.nodes.children[nodes][:, None] +
+                     np.arange(self.nodes.n_children)).ravel()
+            nodes = nodes[self.nodes.children[nodes] < LEAF]
+        self.close()
+
+    def _levels(self, root=0, fetch=True):
+        ''' Nodes of the subtree of a node, grouped by level
 
         Args:
-            coords(:obj:`list` of :obj:`slice`): Indexes to perform the get
-                operation.
+            root (int): Index of the root of the subtree.
+            fetch (bool): If False, the nodes not loaded from the hdf5 file
+                are not traversed.
+        Returns:
+            (:obj:`list` of :obj:`np.array` of int): Index of the nodes of
+                each level of the subtree, in breadth first order.
+        '''
+        levels = [np.array([root], dtype=np.int64)]
+        while True:
+            if fetch:
+                self._fetch(levels[-1])
+            first = self.nodes.children[levels[-1]]
+            first = first[first > LEAF]
+            if not len(first):
+                return levels
+            levels.append((first[:, None] +
+                           np.arange(self.nodes.n_children)).ravel())
+
+    def _compact(self, root=0):
+        ''' Copy the nodes in breadth first order, without released blocks
 
+        Args:
+            root (int): Index of the root of the subtree to copy.
         Returns:
-            (:obj:`np.array`): Numpy array with the slices correspondant to
-                each dimension of the children nodes.
+            (:obj:`tuple` of :obj:`np.array`): Index of the first child and
+                attributes of each node, and the index of the first node of
+                each level (plus the total number of nodes).
         '''
-        # TODO : Refactor
+        order = self._levels(root)
+        levels = np.cumsum([0] + [len(o) for o in order])
+        order = np.concatenate(order)
+        new_index = np.empty(self.nodes.size, dtype=np.int64)
+        new_index[order] = np.arange(len(order))
+        children = self.nodes.children[order]
+        children = np.where(children == LEAF, LEAF,
+                            new_index[np.maximum(children, 0)])
+        return children, self.nodes.attrs[order], levels
+
+    def _split(self, nodes):
+        ''' Split nodes in sub-nodes
+
+        This method create 2 ^ N leafs for each of the leafs in nodes, with
+        their same attributes. The internal nodes are ignored.
+        '''
+        nodes = nodes[self.nodes.children[nodes] == LEAF]
+        self.nodes.children[nodes] = self.nodes.alloc(self.nodes.attrs[nodes])
 
-        return divided_ranges
+    def _prune(self, nodes):
+        ''' Remove all the descendants of the nodes, converting them in leafs
+        '''
+        first = self.nodes.children[nodes]
+        self.nodes.children[nodes] = LEAF
+        # The nodes not loaded from the hdf5 file are just discarded
+        discarded = np.sum(first < LEAF)
+        first = first[first > LEAF]
+        while len(first):
+            children = (first[:, None] +
+                        np.arange(self.nodes.n_children)).ravel()
+            grandchildren = self.nodes.children[children]
+            self.nodes.free(first)
+            discarded += np.sum(grandchildren < LEAF)
+            first = grandchildren[grandchildren > LEAF]
+        if discarded:
+            self._drop_stubs(discarded)
+
+    def _search(self, key, target, occupied):
+        ''' Best first search of a leaf
 
-    def _get_nodes(self, coords):
-        ''' Parse coords method
+        Args:
+            key (function): Function of the origins and size of a group of
+                nodes that returns the priority of each one. Nodes with
+                infinite priority are discarded.
+            target (function): Function of the origin, size and priority of
+                the leaf found that returns the point (in leafs) whose
+                element is returned.
+            occupied (bool): Search occupied or empty leafs.
+        Returns:
+            (:obj:`tuple`): Priority of the leaf found, coordinates of the
+                center of the element and its attributes, or None.
+        '''
+        size = 2 ** self.max_depth
+        root = np.zeros(self.dims, dtype=np.int64)
+        tiebreak = itertools.count()
+        heap = [(float(key(root, size)), next(tiebreak), 0, 0, root)]
+        while heap:
+            priority, _, node, level, origin = heapq.heappop(heap)
+            if priority == np.inf:
+                break
+            size = 2 ** (self.max_depth - level)
+            self._fetch(np.array([node]))
+            first = self.nodes.children[node]
+            if first == LEAF:
+                attrs = self.nodes.attrs[node]
+                if np.any(attrs != self.dflt_attrs) != occupied:
+                    # Only the root is not checked before being queued
+                    continue
+                cell = np.clip(np.floor(target(origin, size, priority)),
+                               origin, origin + size - 1)
+                center = self.ranges[:, 0] + (cell + .5) * self.resolution
+                return priority, center, attrs.copy()
+            half = size // 2
+            children = first + np.arange(self.nodes.n_children)
+            origins = origin + self._bits * half
+            filled = self._node_aggregates(children, level + 1)['occupied']
+            valid = filled > 0 if occupied else filled < half ** self.dims
+            for child, child_origin, child_key in zip(
+                    children[valid], origins[valid],
+                    key(origins[valid], half)):
+                heapq.heappush(heap, (float(child_key), next(tiebreak),
+                                      child, level + 1, child_origin))
+        return None
+
+    def _build_aggregates(self):
+        ''' Calculate the aggregates of all the nodes, if not done yet
+
+        The ones of the nodes not loaded are read from the hdf5 file. The
+        lazy trees opened from files without aggregates are loaded
+        completely.
+        '''
+        if self._aggs is not None:
+            return
+        if self._stubs and (self._source is None or
+                            '/aggregates' not in self._source):
+            self._fetch_all()
+        dtype = self.nodes.attrs.dtype
+        self._aggs = {'count': np.zeros((0, self.n_attrs), dtype=np.int64),
+                      'sum': np.zeros((0, self.n_attrs)),
+                      'min': np.zeros((0, self.n_attrs), dtype=dtype),
+                      'max': np.zeros((0, self.n_attrs), dtype=dtype),
+                      'occupied': np.zeros(0, dtype=np.int64)}
+        levels = self._levels(fetch=False)
+        for level in range(len(levels) - 1, -1, -1):
+            self._update_aggregates(levels[level], level)
+
+    def _update_aggregates(self, nodes, level):
+        ''' Recalculate the aggregates of internal nodes from their children
 
         Args:
-            list / np.array / int / slice
+            nodes (:obj:`np.array` of int): Index of the nodes. The leafs are
+                ignored.
+            level (int): Depth of the nodes.
+        '''
+        first = self.nodes.children[nodes]
+        first = first[first > LEAF]
+        if not len(first):
+            return
+        self._grow_aggregates()
+        rows = (first[:, None] + np.arange(self.nodes.n_children)).ravel()
+        aggs = self._node_aggregates(rows, level + 1)
+        blocks = _block(first, self.nodes.n_children)
+        for name, reduction in (('count', np.sum), ('sum', np.sum),
+                                ('min', np.min), ('max', np.max),
+                                ('occupied', np.sum)):
+            values = aggs[name].reshape((len(first),
+                                         self.nodes.n_children) +
+                                        aggs[name].shape[1:])
+            self._aggs[name][blocks] = reduction(values, axis=1)
+
+    def _grow_aggregates(self):
+        ''' Grow the cache of aggregates to the blocks of the storage '''
+        n_blocks = (self.nodes.size - 1) // self.nodes.n_children
+        size = len(self._aggs['occupied'])
+        if size >= n_blocks:
+            return
+        capacity = max(size, 64)
+        while capacity < n_blocks:
+            capacity *= 2
+        for name, array in self._aggs.items():
+            self._aggs[name] = np.zeros((capacity,) + array.shape[1:],
+                                        dtype=array.dtype)
+            self._aggs[name][:size] = array
+
+    def _node_aggregates(self, nodes, level, volume=None):
+        ''' Aggregates of the subtrees of some nodes
+
+        The aggregates of the leafs are calculated from their attributes,
+        and the ones of the internal nodes are read from the cache, or from
+        the hdf5 file if they are not loaded.
 
+        Args:
+            nodes (:obj:`np.array` of int): Index of the nodes.
+            level (int): Depth of the nodes.
+            volume (:obj:`np.array` of int): Number of leafs at the max
+                depth to aggregate in each leaf. By default, all of them.
         Returns:
-            (:obj:`np.array`): Numpy array of shape [2 x n_dimensions x 2].
-                Each dimension has two ranges, one for each subdivision.
-                Eachrange is indicated as [start, end].
-                For example [[[start_x_1, end_x_1], [start_x_2, end_x_2]],
-                [[start_y_1, end_y_1], [start_y_2, end_y_2]]]
+            (:obj:`dict`): Arrays with the count, sum, min, max and number
+                of occupied leafs of each node.
         '''
+        attrs = self.nodes.attrs[nodes].astype(float)
+        if volume is None:
+            volume = np.full(len(nodes), 2 ** (self.dims *
+                                               (self.max_depth - level)))
+        first = self.nodes.children[nodes]
+        used = attrs != self.dflt_attrs
+        aggs = {'count': used * volume[:, None],
+                'sum': attrs * volume[:, None],
+                'min': attrs.copy(),
+                'max': attrs.copy(),
+                'occupied': np.any(used, axis=-1) * volume}
+        loaded, stub = first > LEAF, first < LEAF
+        blocks = _block(first[loaded], self.nodes.n_children)
+        for name, values in aggs.items():
+            values[loaded] = self._aggs[name][blocks]
+        if np.any(stub):
+            stub_aggs = self._read_aggregates(STUB - first[stub])
+            for name, values in aggs.items():
+                values[stub] = stub_aggs[name]
+        return aggs
+
+    def _merge(self):
+        ''' Merge the modified nodes, unless the merges are deferred '''
+        if not self._deferred:
+            self.compact()
 
-        coords = self.divided_ranges(coords)
-        nodes_items = np.empty(coords.shape, dtype=object)
+    def _merge_nodes(self, nodes):
+        ''' Merge operation
 
-        for idx, s in np.ndenumerate(coords):
-            nodes_items[idx] = self.nodes[idx].__getitem__(s)
+        Convert in leafs the nodes whose children are all leafs with the
+        same attributes.
 
-        return np.block(nodes_items)
+        Args:
+            nodes (:obj:`np.array` of int): Index of the nodes to check.
+        '''
+        first = self.nodes.children[nodes]
+        # The children not loaded were already merged when stored
+        nodes, first = nodes[first > LEAF], first[first > LEAF]
+        rows = first[:, None] + np.arange(self.nodes.n_children)
+        attrs = self.nodes.attrs[rows]
+        # Compare all the children to the first one
+        same = np.all(self.nodes.children[rows] == LEAF, axis=-1) & \
+            np.all(attrs == attrs[:, :1], axis=(-2, -1))
+        self.nodes.attrs[nodes[same]] = attrs[same, 0]
+        self.nodes.children[nodes[same]] = LEAF
+        self.nodes.free(first[same])
+
+
+class NodeArray(object):
+    ''' NodeArray object
+
+    Flat storage of the nodes of a tree. The nodes are allocated in blocks
+    of n_children siblings, so a node only needs to store the index of its
+    first child. The arrays grow geometrically, and the blocks released by
+    merges are reused by the next allocations.
 
-    def _set_nodes(self, coords, value):
-        ''' Method to read the sub-nodes in a getitem operation
+    Attributes:
+        n_children (int): Number of nodes per block (2 ^ N).
+        children (:obj:`np.array` of int): Index of the first child of each
+            node, or LEAF if it has no children.
+        attrs (:obj:`np.array`): Array of shape [capacity, n_attrs] with the
+            attributes of each node.
+        size (int): Number of rows used (including the released ones).
 
-        This method calculates the
+    '''
+    def __init__(self, n_children, attrs, dtype=float, capacity=64):
+        self.n_children = n_children
+        self.children = np.full(capacity, LEAF, dtype=np.int64)
+        self.attrs = np.zeros((capacity, len(attrs)), dtype=dtype)
+        # The root is the only node outside a block
+        self.attrs[0] = attrs
+        self.size = 1
+        self._free = np.empty(0, dtype=np.int64)
+
+    @property
+    def n_nodes(self):
+        ''' Number of nodes in use '''
+        return self.size - len(self._free) * self.n_children
+
+    @property
+    def nbytes(self):
+        ''' Memory used by the node arrays in bytes '''
+        return self.children.nbytes + self.attrs.nbytes
+
+    def _grow(self, size):
+        ''' Resize the arrays to store at least size nodes '''
+        capacity = len(self.children)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        children = np.full(capacity, LEAF, dtype=np.int64)
+        children[:self.size] = self.children[:self.size]
+        attrs = np.zeros((capacity, self.attrs.shape[1]),
+                         dtype=self.attrs.dtype)
+        attrs[:self.size] = self.attrs[:self.size]
+        self.children, self.attrs = children, attrs
+
+    def alloc(self, attrs):
+        ''' Allocate blocks of leafs
 
         Args:
-            coords (:obj:`np.array`): Numpy array of shape [n_dimensions x 2].
-                For each dimension, the range is indicated as [start, end].
-                For example [[start_x, end_x], [start_y, end_y]]
+            attrs (:obj:`np.array`): Array of shape [n_blocks, n_attrs] with
+                the attributes of the leafs of each block.
         Returns:
-            (:obj:`np.array`): Numpy array of shape
-                [range_x, range_y, ..., n_attrs]. The representation of the
-                object mapped in these coordinates of the trees.
+            (:obj:`np.array` of int): Index of the first node of each block.
         '''
-        status = True
-        coords = self.divided_ranges(coords)
+        n_blocks = len(attrs)
+        # Reuse the released blocks first
+        n_reused = min(n_blocks, len(self._free))
+        reused = self._free[len(self._free) - n_reused:]
+        self._free = self._free[:len(self._free) - n_reused]
+        new = self.size + self.n_children * np.arange(n_blocks - n_reused,
+                                                      dtype=np.int64)
+        self._grow(self.size + self.n_children * len(new))
+        self.size += self.n_children * len(new)
+        starts = np.concatenate([reused, new])
+        rows = (starts[:, None] + np.arange(self.n_children)).ravel()
+        self.children[rows] = LEAF
+        self.attrs[rows] = np.repeat(attrs, self.n_children, axis=0)
+        return starts
+
+    def assign(self, children, attrs):
+        ''' Replace the contents of the storage
 
-        for idx, s in np.ndenumerate(coords):
-            status &= self.nodes[idx].__setitem__(s, value)
-        return status
+        Args:
+            children (:obj:`np.array` of int): Index of the first child of
+                each node.
+            attrs (:obj:`np.array`): Attributes of each node.
+        '''
+        self.children = np.array(children, dtype=np.int64)
+        self.attrs = np.array(attrs, dtype=self.attrs.dtype)
+        self.size = len(self.children)
+        self._free = np.empty(0, dtype=np.int64)
+
+    def free(self, starts):
+        ''' Release the blocks of nodes starting at starts '''
+        rows = (starts[:, None] + np.arange(self.n_children)).ravel()
+        self.children[rows] = LEAF
+        self._free = np.concatenate([self._free, starts])
+
+
+def _map(function, tasks, processes):
+    ''' Run a function over a list of tasks in a pool of processes '''
+    pool = multiprocessing.Pool(min(processes, max(len(tasks), 1)))
+    try:
+        return pool.map(function, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _subtree(children, attrs, dflt_attrs, max_depth, dims):
+    ''' Create a tree in a worker process from the nodes of a subtree '''
+    tree = Ntree(n_dimensions=dims, attrs=dflt_attrs, max_depth=max_depth,
+                 dtype=attrs.dtype)
+    tree.nodes.assign(children, attrs)
+    return tree
+
+
+def _write_subtree(task):
+    ''' Apply a batch of boxes to a subtree in a worker process
+
+    Returns:
+        (:obj:`tuple` of :obj:`np.array`): Nodes of the subtree after the
+            merge, as returned by Ntree._compact.
+    '''
+    children, attrs, lo, hi, values, dflt_attrs, max_depth = task
+    tree = _subtree(children, attrs, dflt_attrs, max_depth, lo.shape[1])
+    tree._write_boxes(lo, hi, values)
+    tree.compact()
+    return tree._compact()[:2]
+
+
+def _block(first, n_children):
+    ''' Index of the blocks of children that start at first. The blocks
+    are stored after the root, so they start at 1 + n * n_children '''
+    return (first - 1) // n_children
+
+
+def _pad(array, value):
+    ''' Pad all the axes but the last of an array to even sizes '''
+    shape = [s + s % 2 for s in array.shape[:-1]] + [array.shape[-1]]
+    if list(array.shape) == shape:
+        return array
+    out = np.empty(shape, dtype=array.dtype)
+    out[...] = value
+    out[tuple(slice(0, s) for s in array.shape)] = array
+    return out
+
+
+def _blocks(array):
+    ''' Group all the axes but the last of an array in blocks of 2 elements
+
+    Args:
+        array (:obj:`np.array`): Array of shape [n_1, ..., n_N, m], with even
+            sizes in the first N axes.
+    Returns:
+        (:obj:`np.array`): Array of shape [n_1 / 2, ..., n_N / 2, 2^N, m],
+            with the elements of each block in the order of the children.
+    '''
+    dims = array.ndim - 1
+    split = []
+    for s in array.shape[:-1]:
+        split += [s // 2, 2]
+    array = array.reshape(split + [array.shape[-1]])
+    array = array.transpose(list(range(0, 2 * dims, 2)) +
+                            list(range(1, 2 * dims, 2)) + [2 * dims])
+    return array.reshape(array.shape[:dims] + (-1, array.shape[-1]))
 
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
 
-    t = Ntree([[0, 100], [0, 100]], 0)
-    plt.imshow(t[:])
-    self = t
+    t = Ntree([[0, 100], [0, 100]], attrs=0)
+    t[20:40, 30:80] = 1
+    t[35:37, 50:52] = 2
+    plt.imshow(t[:][..., 0])
+    plt.show()
@@ -9,19 +9,25 @@ Tool to extract from g-code file a voxelized version of the piece. The voxels
 store attributes such as direction, speed, temperature and material.
 
 Examples:
-    $ python stl_to_amf.py file1.stl file2.stl --output_path 'out.amf'
+    $ python gcode_to_voxel.py piece.gcode piece.hdf5
 
-    $ python stl_to_amf.py -custom_config --config_path config.yaml
-        file1.stl profile_1 file2.stl profile_2
+    $ python gcode_to_voxel.py piece.gcode piece.hdf5 -profile
+        --profile_path profile.json
 
 
 @author: carlgval
 """
 
+import argparse
+import os
+import sys
 import tables
 import numpy as np
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from instrumentation import DISABLED, Profiler, print_progress
+
 N_ATTRIBUTES = 5
 RESOLUTION = 0.1
 
@@ -33,13 +39,24 @@ class Parser(object):
 
     G-Code parser that generates the voxelized representation.
 
+    Attributes:
+        profiler (:obj:`Profiler`): Profiler of the stages and counters of
+            the parse.
+
     '''
-    def __init__(self, gcode_file, ouput_file):
+    def __init__(self, gcode_file, ouput_file, profiler=DISABLED):
         self.gcode_file = gcode_file
-        self.voxels_repr = Voxels(ouput_file)
+        self.profiler = profiler
+        self.voxels_repr = Voxels(ouput_file, profiler=profiler)
         self.width = 0.5
 
     def parse(self):
+        # The rasterize and write stages run inside this one, so its time
+        # is only the one spent reading and parsing the lines
+        with self.profiler.stage('parse'):
+            self._parse()
+
+    def _parse(self):
 
         state = {'material': 0.,
                  'direction_x': 0.,
@@ -79,14 +96,15 @@ class Parser(object):
 
                 i += 1
 
-                print('%i lines processed' % i)
+                self.profiler.count('lines parsed')
 
             self.voxels_repr.write_keys(str(state.keys()))
 
 
 class Voxels(object):
 
-    def __init__(self, path=None, size=[200, 200]):
+    def __init__(self, path=None, size=[200, 200], profiler=DISABLED):
+        self.profiler = profiler
         self.hdf5_file = tables.open_file(path, 'w')
         self.size = [int(s / RESOLUTION) for s in size]
         self.prev_z = 0
@@ -107,13 +125,15 @@ class Voxels(object):
             self._dump_layer()
         z = int(round(z / RESOLUTION, 0))
         self.layer_height = z - self.prev_z
-        self.layer = Layer(self.size)
+        self.layer = Layer(self.size, profiler=self.profiler)
         self.prev_z = z
 
     def _dump_layer(self):
-        for i in range(int(self.layer_height / RESOLUTION)):
-            self.table.append(self.layer.layer.reshape(self.size +
-                                                       [1, N_ATTRIBUTES]))
+        with self.profiler.stage('write'):
+            for i in range(int(self.layer_height / RESOLUTION)):
+                self.table.append(self.layer.layer.reshape(self.size +
+                                                           [1, N_ATTRIBUTES]))
+                self.profiler.count('bytes out', self.layer.layer.nbytes)
 
     def write_keys(self, keys):
         self.table.attrs['keys'] = keys
@@ -124,7 +144,8 @@ class Voxels(object):
 
 
 class Layer(object):
-    def __init__(self, size=[2000, 2000]):
+    def __init__(self, size=[2000, 2000], profiler=DISABLED):
+        self.profiler = profiler
         self.layer = np.zeros(size + [N_ATTRIBUTES])
 
     def create_mask(self, width):
@@ -135,6 +156,10 @@ class Layer(object):
         return mask
 
     def fill_traj(self, pos_1, pos_2, data, width):
+        with self.profiler.stage('rasterize'):
+            self._fill_traj(pos_1, pos_2, data, width)
+
+    def _fill_traj(self, pos_1, pos_2, data, width):
         x_1, y_1 = pos_1
         x_2, y_2 = pos_2
         steps = int(max(abs(x_1 - x_2), abs(y_1 - y_2)) / RESOLUTION)
@@ -147,11 +172,35 @@ class Layer(object):
         for x, y in traj:
             x = int(round(x, 0))
             y = int(round(y, 0))
-            print(x, y, w)
 
             self.layer[(x - w):(x + w + 1), (y - w):(y + w + 1)][mask] = masked_data
 
-i='/home/carlgval/Documents/Atico/devel/pipeline/tests/test/out.gcode'
-o='/home/carlgval/Documents/Atico/devel/pipeline/tests/test/out.hdf5'
-p=Parser(i, o)
-p.parse()
\ No newline at end of file
+        self.profiler.count('segments rasterized')
+        self.profiler.count('voxels written', steps * len(masked_data))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    # Define the program arguments
+    parser.add_argument('gcode_file', type=str,
+                        help='Path to the g-code file')
+    parser.add_argument('output_file', type=str,
+                        help='Path to save the hdf5 output')
+    parser.add_argument('-profile', action='store_true',
+                        help='flag that enables the progress reports and '
+                        'the stage timers')
+    parser.add_argument('--profile_interval', type=float, default=1.,
+                        help='Seconds between progress reports')
+    parser.add_argument('--profile_path', type=str, default=None,
+                        help='Path to save the profile as json at exit')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    profiler = Profiler(enabled=args.profile,
+                        callback=print_progress,
+                        interval=args.profile_interval,
+                        json_path=args.profile_path)
+    p = Parser(args.gcode_file, args.output_file, profiler=profiler)
+    p.parse()
\ No newline at end of file
@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:40:00 2026
+
+ntree-benchmark
+
+Benchmark of the Ntree storage against the dense layout used by Voxels (a
+numpy array with the attributes in the last axis). For each number of
+dimensions, max depth and fill pattern, a tree and a dense array are filled
+with the same data, and the script measures:
+
+    * set: voxels written per second.
+    * merge: voxels per second of the merge pass, when the writes are
+      deferred.
+    * get: random points read per second, and voxels per second when a
+      region is converted to a dense array.
+    * nodes / voxel and bytes / voxel of the storage.
+    * peak RSS: increase of the resident memory of the process during the
+      case. Each case runs in a new process.
+
+The fill patterns are:
+
+    * shell: the surface of a sphere, one voxel thick (sparse).
+    * infill: a solid block filled with parallel lines (dense).
+    * noise: random voxels with random attributes (worst case for the tree).
+
+Examples:
+    $ python ntree_benchmark.py
+
+    $ python ntree_benchmark.py --dims 3 --depths 6 7 8 --patterns shell
+        --json results.json
+
+@author: carlgval
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+
+from NTree import Ntree
+
+PATTERNS = ('shell', 'infill', 'noise')
+
+
+def make_pattern(pattern, dims, depth, n_attrs, density=0.01, seed=0):
+    '''Create the data of a fill pattern
+
+    Args:
+        pattern (str): Name of the pattern.
+        dims (int): Number of dimensions.
+        depth (int): Max depth of the tree. The space has 2^depth voxels in
+            each dimension.
+        n_attrs (int): Number of attributes of each voxel.
+        density (float): Fraction of voxels set by the noise pattern.
+        seed (int): Seed of the random values.
+
+    Returns:
+        (:obj:`tuple` of :obj:`np.array`): Start and (excluded) end voxel of
+            each box of the pattern, with shape [n_boxes, dims], and the
+            attributes of each box, with shape [n_boxes, n_attrs].
+    '''
+    rng = np.random.RandomState(seed)
+    size = 2 ** depth
+    if pattern == 'shell':
+        # Voxels whose center is at less than half a voxel of the sphere,
+        # searched one slice at a time to keep the memory low
+        radius = size * 0.4
+        grid = np.indices((size,) * (dims - 1)).reshape(dims - 1, -1).T
+        lo = []
+        for i in range(size):
+            distance = np.sqrt((i + 0.5 - size / 2.) ** 2 + np.sum(
+                (grid + 0.5 - size / 2.) ** 2, axis=-1))
+            shell = grid[np.abs(distance - radius) < 0.5]
+            lo.append(np.hstack([np.full((len(shell), 1), i), shell]))
+        lo = np.concatenate(lo)
+        hi = lo + 1
+        values = np.tile(np.arange(1, n_attrs + 1), (len(lo), 1))
+    elif pattern == 'infill':
+        # Lines along the first axis every two voxels of the second one,
+        # covering all the rest of the axes
+        start, end = size // 8, size - size // 8
+        lines = np.arange(start, end, 2)
+        lo = np.full((len(lines), dims), start)
+        hi = np.full((len(lines), dims), end)
+        lo[:, 1], hi[:, 1] = lines, lines + 1
+        values = np.tile(np.arange(1, n_attrs + 1), (len(lo), 1))
+    elif pattern == 'noise':
+        n_voxels = int(density * size ** dims)
+        lo = rng.randint(0, size, (n_voxels, dims))
+        hi = lo + 1
+        values = rng.randint(1, 4, (n_voxels, n_attrs))
+    else:
+        raise ValueError('Not valid pattern: %s' % pattern)
+    return lo.astype(np.int64), hi.astype(np.int64), values.astype(float)
+
+
+def _peak_rss():
+    '''Peak resident memory of the process in bytes'''
+    # ru_maxrss is in kilobytes in Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_tree(lo, hi, values, dims, depth, queries):
+    '''Benchmark the Ntree storage
+
+    Args:
+        lo, hi (:obj:`np.array` of int): Boxes of the pattern.
+        values (:obj:`np.array`): Attributes of each box.
+        dims (int): Number of dimensions.
+        depth (int): Max depth of the tree.
+        queries (:obj:`np.array` of float): Points to read.
+
+    Returns:
+        (:obj:`dict`): Measures of the case.
+    '''
+    rss = _peak_rss()
+    size = 2 ** depth
+    tree = Ntree([[0, size]] * dims, attrs=[0] * values.shape[1],
+                 max_depth=depth)
+    boxes = np.stack([lo, hi], axis=-1)
+    n_voxels = np.sum(np.prod(hi - lo, axis=-1))
+
+    start = time.time()
+    with tree.deferred():
+        tree.set_boxes(boxes, values)
+        set_time = time.time() - start
+    merge_time = time.time() - start - set_time
+
+    start = time.time()
+    tree.get_points(queries)
+    get_time = time.time() - start
+
+    region = (slice(0, size // 2),) * dims
+    start = time.time()
+    tree.to_dense(region)
+    dense_time = time.time() - start
+
+    total = float(size ** dims)
+    return {'set': n_voxels / set_time,
+            'merge': n_voxels / merge_time,
+            'get': len(queries) / get_time,
+            'to_dense': (size // 2) ** dims / dense_time,
+            'nodes_per_voxel': tree.n_nodes / total,
+            'bytes_per_voxel': tree.nodes.nbytes / total,
+            'peak_rss': int(_peak_rss() - rss)}
+
+
+def bench_dense(lo, hi, values, dims, depth, queries):
+    '''Benchmark the dense layout used by Voxels
+
+    Args:
+        lo, hi (:obj:`np.array` of int): Boxes of the pattern.
+        values (:obj:`np.array`): Attributes of each box.
+        dims (int): Number of dimensions.
+        depth (int): Size of the array, as 2^depth in each dimension.
+        queries (:obj:`np.array` of float): Points to read.
+
+    Returns:
+        (:obj:`dict`): Measures of the case.
+    '''
+    rss = _peak_rss()
+    size = 2 ** depth
+    n_voxels = np.sum(np.prod(hi - lo, axis=-1))
+
+    start = time.time()
+    array = np.zeros((size,) * dims + (values.shape[1],))
+    if np.all(hi - lo == 1):
+        array[tuple(lo.T)] = values
+    else:
+        for box_lo, box_hi, value in zip(lo, hi, values):
+            array[tuple(slice(a, b) for a, b in zip(box_lo, box_hi))] = value
+    set_time = time.time() - start
+
+    start = time.time()
+    array[tuple(queries.astype(np.int64).T)]
+    get_time = time.time() - start
+
+    start = time.time()
+    array[(slice(0, size // 2),) * dims].copy()
+    dense_time = time.time() - start
+
+    total = float(size ** dims)
+    return {'set': n_voxels / set_time,
+            'merge': None,
+            'get': len(queries) / get_time,
+            'to_dense': (size // 2) ** dims / dense_time,
+            'nodes_per_voxel': None,
+            'bytes_per_voxel': array.nbytes / total,
+            'peak_rss': int(_peak_rss() - rss)}
+
+
+def run_case(case):
+    '''Run a benchmark case. Used as the task of the pool of processes'''
+    storage, pattern, dims, depth, n_attrs, n_queries, density = case
+    lo, hi, values = make_pattern(pattern, dims, depth, n_attrs, density)
+    queries = np.random.RandomState(1).uniform(0, 2 ** depth,
+                                               (n_queries, dims))
+    bench = bench_tree if storage == 'tree' else bench_dense
+    result = bench(lo, hi, values, dims, depth, queries)
+    result.update({'storage': storage,
+                   'pattern': pattern,
+                   'dims': dims,
+                   'depth': depth,
+                   'voxels': int(np.sum(np.prod(hi - lo, axis=-1)))})
+    return result
+
+
+def _format(value):
+    '''Format a measure for the results table'''
+    if value is None:
+        return '-'
+    if isinstance(value, (int, np.integer)):
+        return '%i' % value
+    if abs(value) >= 1e4:
+        return '%.3g' % value
+    return '%.3f' % value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # Define the program arguments
+    parser.add_argument('--dims', type=int, nargs='+', default=[2, 3],
+                        help='Number of dimensions of the trees')
+    parser.add_argument('--depths', type=int, nargs='+', default=[6, 8],
+                        help='Max depths of the trees')
+    parser.add_argument('--patterns', type=str, nargs='+',
+                        default=list(PATTERNS), choices=PATTERNS,
+                        help='Fill patterns')
+    parser.add_argument('--n_attrs', type=int, default=5,
+                        help='Number of attributes per voxel')
+    parser.add_argument('--queries', type=int, default=100000,
+                        help='Number of random points read')
+    parser.add_argument('--density', type=float, default=0.01,
+                        help='Fraction of voxels set by the noise pattern')
+    parser.add_argument('--max_dense_mb', type=float, default=2048,
+                        help='Skip the dense cases bigger than this size')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Path to save the results as json')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    cases = []
+    for dims in args.dims:
+        for depth in args.depths:
+            dense_mb = 8. * args.n_attrs * 2 ** (dims * depth) / 2 ** 20
+            for pattern in args.patterns:
+                cases.append(('tree', pattern, dims, depth, args.n_attrs,
+                              args.queries, args.density))
+                if dense_mb <= args.max_dense_mb:
+                    cases.append(('dense', pattern, dims, depth,
+                                  args.n_attrs, args.queries, args.density))
+                else:
+                    print('WARNING: Skipping dense %id depth %i (%.0f MB)'
+                          % (dims, depth, dense_mb))
+
+    # Each case runs in a new process, so the peak RSS is not shared
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = []
+    columns = ['storage', 'pattern', 'dims', 'depth', 'voxels', 'set',
+               'merge', 'get', 'to_dense', 'nodes_per_voxel',
+               'bytes_per_voxel', 'peak_rss']
+    print(' '.join('%15s' % c for c in columns))
+    try:
+        for result in pool.imap(run_case, cases, chunksize=1):
+            results.append(result)
+            print(' '.join('%15s' % (result[c] if type(result[c]) is str
+                                     else _format(result[c]))
+                           for c in columns))
+    finally:
+        pool.close()
+        pool.join()
+
+    # Export the results
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
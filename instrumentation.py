@@ -0,0 +1,172 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:05:00 2026
+
+Instrumentation shared by the scripts.
+
+A Profiler accumulates the time spent in each stage of a script and a set of
+counters (lines parsed, voxels written...). The progress is reported through
+a callback, called at most once per interval, so reporting does not slow down
+the hot loops. When the profiler is disabled all its methods return
+immediately.
+
+The stages can be nested, and the time of each stage is exclusive: the time
+spent in the stages opened inside it is only added to the inner ones. So the
+times of all the stages add up to the measured time, and each one is the time
+of its own work.
+
+Examples:
+    profiler = Profiler(callback=print_progress, json_path='profile.json')
+    with profiler.stage('parse'):
+        for line in lines:
+            profiler.count('lines parsed')
+
+@author: carlgval
+"""
+
+import atexit
+import json
+import sys
+import time
+
+
+class Profiler(object):
+    '''Profiler object
+
+    Per-stage timers and counters with throttled progress reports.
+
+    Attributes:
+        enabled (bool): If False, nothing is measured nor reported.
+        callback (function): Function called with the report (see
+            :meth:`report`) to show the progress.
+        interval (float): Min time in seconds between two progress reports.
+        stages (:obj:`dict`): Total exclusive time and number of calls of
+            each stage.
+        counters (:obj:`dict`): Value of each counter.
+
+    Args:
+        enabled (bool): If False, nothing is measured nor reported.
+        callback (function): Function called with the report to show the
+            progress.
+        interval (float): Min time in seconds between two progress reports.
+        json_path (str): If used, the report is saved as json in this path
+            when the program exits.
+    '''
+    def __init__(self, enabled=True, callback=None, interval=1.,
+                 json_path=None):
+        self.enabled = enabled
+        self.callback = callback
+        self.interval = interval
+        self.stages = {}
+        self.counters = {}
+        # Stages currently open, from the outermost to the innermost
+        self._open = []
+        self._start = time.time()
+        self._last_report = self._start
+        if enabled and json_path is not None:
+            atexit.register(self.dump, json_path)
+
+    def stage(self, name):
+        '''Context manager that measures the time spent in a stage
+
+        Args:
+            name (str): Name of the stage. The times of all the uses of the
+                same stage are added. The time of the stages nested inside
+                it is not included.
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        '''Increase a counter and report the progress if it is time to
+
+        Args:
+            name (str): Name of the counter.
+            n (int): Amount to add.
+        '''
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.callback is not None:
+            now = time.time()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self.callback(self.report())
+
+    def report(self):
+        '''Current state of the measures
+
+        Returns:
+            (:obj:`dict`): Elapsed time since the creation of the profiler,
+                time and calls of each stage, and value and rate (per second
+                of elapsed time) of each counter.
+        '''
+        elapsed = time.time() - self._start
+        return {'elapsed': elapsed,
+                'stages': dict((k, dict(v)) for k, v in self.stages.items()),
+                'counters': dict((k, {'value': v,
+                                      'rate': v / max(elapsed, 1e-9)})
+                                 for k, v in self.counters.items())}
+
+    def dump(self, path):
+        '''Save the report as json
+
+        Args:
+            path (str): Path of the json file.
+        '''
+        with open(path, 'w') as json_file:
+            json.dump(self.report(), json_file, indent=2, sort_keys=True)
+
+
+class _Stage(object):
+    '''Context manager that adds its exclusive duration to a stage of a
+    profiler'''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.nested = 0.
+
+    def __enter__(self):
+        self.start = time.time()
+        self.profiler._open.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.start
+        stage = self.profiler.stages.setdefault(self.name,
+                                                {'time': 0., 'calls': 0})
+        stage['time'] += duration - self.nested
+        stage['calls'] += 1
+        self.profiler._open.pop()
+        # The time of this stage is not counted again in the outer one
+        if self.profiler._open:
+            self.profiler._open[-1].nested += duration
+        return False
+
+
+class _NullStage(object):
+    '''Context manager used by the disabled profilers'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+# Profiler used when none is given
+DISABLED = Profiler(enabled=False)
+
+
+def print_progress(report):
+    '''Progress callback that prints the counters in one line of stderr
+
+    Args:
+        report (:obj:`dict`): Report of the profiler.
+    '''
+    counters = ', '.join('%s: %i (%.0f/s)' % (k, v['value'], v['rate'])
+                         for k, v in sorted(report['counters'].items()))
+    sys.stderr.write('[%7.1fs] %s\n' % (report['elapsed'], counters))
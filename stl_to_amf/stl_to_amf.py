@@ -17,14 +17,21 @@ Examples:
     $ python stl_to_amf.py -custom_config --config_path config.yaml
         file1.stl profile_1 file2.stl profile_2
 
+    $ python stl_to_amf.py file1.stl file2.stl --output_path 'out.amf'
+        -profile --profile_path profile.json
+
 @author: carlgval
 """
 
 import argparse
 import os
+import sys
 import yaml
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from instrumentation import DISABLED, Profiler, print_progress
+
 
 class Triangle(object):
     '''Triangle class
@@ -179,10 +186,13 @@ class Amf(object):
             compose the file.
         vertices (:obj:`list` of :obj:`Vertex`): List of vertices of the
             triangles defined in the volumes.
+        profiler (:obj:`Profiler`): Profiler of the stages and counters of
+            the conversion.
     '''
-    def __init__(self, volumes=[], vertices=[]):
+    def __init__(self, volumes=[], vertices=[], profiler=DISABLED):
         self.volumes = volumes
         self.vertices = vertices
+        self.profiler = profiler
 
     def append_stl(self, file_path, metadata=None):
         '''Append stl method
@@ -197,9 +207,22 @@ class Amf(object):
                 and v the value.
         '''
         # Read the stl
-        with open(file_path) as f:
-            text = f.read()
+        with self.profiler.stage('read'):
+            with open(file_path) as f:
+                text = f.read()
+        self.profiler.count('bytes in', len(text))
+
+        with self.profiler.stage('merge'):
+            self._append_facets(text, metadata)
 
+    def _append_facets(self, text, metadata):
+        '''Parse the facets of an stl and add them as a new volume
+
+        Args:
+            text (:obj:`str`): Contents of the stl file.
+            metadata (:obj:`dict`): Dictionary of metadata, being k the tag
+                and v the value.
+        '''
         # Parse the facets
         facets = re.findall('facet ((?s).+?) endfacet', text)
         triangles = []
@@ -219,10 +242,12 @@ class Amf(object):
                     # If it is not defined, create a new one.
                     self.vertices.append(Vertex(x, y, z))
                     idx = len(self.vertices) - 1
+                    self.profiler.count('vertices')
                 # Store the index of the point
                 temp_v.append(idx)
             # Create a new triangle with the indexes and add it to the list
             triangles.append(Triangle(*temp_v))
+            self.profiler.count('triangles merged')
         # Create a new volume with the triangles and add it to the list
         self.volumes.append(Volume(triangles, metadata=metadata))
 
@@ -299,6 +324,18 @@ if __name__ == '__main__':
                         default=os.path.join(curr_path, 'amf_config.yaml'),
                         help='Path to the configurations')
 
+    parser.add_argument('-profile', action='store_true',
+                        help='flag that enables the progress reports and '
+                        'the stage timers')
+
+    parser.add_argument('--profile_interval',
+                        type=float, default=1.,
+                        help='Seconds between progress reports')
+
+    parser.add_argument('--profile_path',
+                        type=str, default=None,
+                        help='Path to save the profile as json at exit')
+
     # Parse the arguments
     args = parser.parse_args()
     print(args.files)
@@ -337,15 +374,22 @@ if __name__ == '__main__':
             stls.append((args.files[i], metadata))
 
     # Create an empty amf
-    amf = Amf()
+    profiler = Profiler(enabled=args.profile,
+                        callback=print_progress,
+                        interval=args.profile_interval,
+                        json_path=args.profile_path)
+    amf = Amf(profiler=profiler)
 
     # Add all files
     for stl, metadata in stls:
         amf.append_stl(stl, metadata=metadata)
 
     # Export the output or print it on the console
-    if args.output_path is None:
-        print(amf)
-    else:
-        with open(args.output_path, "w") as text_file:
-            text_file.write(amf.__repr__())
+    with profiler.stage('write'):
+        text = amf.__repr__()
+        if args.output_path is None:
+            print(text)
+        else:
+            with open(args.output_path, "w") as text_file:
+                text_file.write(text)
+    profiler.count('bytes out', len(text))